@@ -0,0 +1,71 @@
+"""
+benchmark.py - measure the speed/quality trade-off of each encoder speed preset
+
+Copyright (C) 2025 Deletecat
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+usage: python3 benchmark.py input_video [input_video ...]
+"""
+
+import asyncio
+import aiofiles.os
+import aiofiles.tempfile
+import re
+import sys
+import time
+import encoder
+
+async def measure_psnr(options,file,mpeg_1_temp):
+    # compare the encoded video against the input, scaled and padded the same way
+    pad_width = int((256-options.width)/2)
+    pad_height = int((192-options.height)/2)
+    proc = await asyncio.create_subprocess_exec("ffmpeg","-i",mpeg_1_temp.name,"-i",file,"-lavfi",
+                                                f"[1:v]fps={options.fps},scale={options.width}:{options.height}:flags=lanczos,"
+                                                f"pad=256:192:{pad_width}:{pad_height}[ref];[0:v][ref]psnr","-f","null","-",
+                                                stdout=asyncio.subprocess.DEVNULL,stderr=asyncio.subprocess.PIPE)
+    output = await proc.communicate()
+
+    # ffmpeg prints the result as "... average:xx.xx ..."
+    psnr = re.compile("average:([0-9.]+|inf)").search(output[1].decode("utf-8"))
+    return psnr.group(1) if psnr else "N/A"
+
+async def benchmark(file):
+    media_info = await encoder.probe_media(file)
+    print(f"{file} ({media_info.duration:.1f}s)")
+    print(f"{'preset':<10} {'encode (s)':>10} {'s/media s':>10} {'size (KB)':>10} {'PSNR (dB)':>10}")
+
+    for preset in encoder.PRESET_ORDER:
+        options = encoder.DPGOpts(24,4,256,192,None,preset)
+        options.verify_inputs()
+
+        async with aiofiles.tempfile.NamedTemporaryFile(suffix=".mpg") as mpeg_1_temp:
+            start = time.monotonic()
+            await encoder.convert_video(options,file,mpeg_1_temp,media_info)
+            encode_time = time.monotonic() - start
+
+            size = (await aiofiles.os.stat(mpeg_1_temp.name)).st_size
+            psnr = await measure_psnr(options,file,mpeg_1_temp)
+
+        print(f"{preset:<10} {encode_time:>10.2f} {encode_time/media_info.duration:>10.3f} {size/1000:>10.1f} {psnr:>10}")
+
+async def main(files):
+    for file in files:
+        await benchmark(file)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1:]))
@@ -21,17 +21,32 @@ Copyright (C) 2025 Deletecat
 import asyncio
 import aiofiles
 import aiofiles.os
+import aiofiles.tempfile
 from PIL import Image
+from fractions import Fraction
 import struct
-import re
+import json
+import io
+
+# mpeg1video settings for each speed preset, ordered from fastest to best quality
+SPEED_PRESETS = {
+    "fast":     ["-mbd","0","-mpv_flags","+mv0","-cmp","0","-subcmp","0","-precmp","0",
+                 "-dia_size","1","-pre_dia_size","1","-last_pred","0"],
+    "balanced": ["-mbd","2","-mpv_flags","+mv0","-cmp","2","-subcmp","2","-precmp","2",
+                 "-dia_size","2","-pre_dia_size","2","-last_pred","2"],
+    "quality":  ["-mbd","2","-trellis","1","-mpv_flags","+cbp_rd","-mpv_flags","+mv0",
+                 "-cmp","6","-subcmp","6","-precmp","6","-dia_size","3","-pre_dia_size","3","-last_pred","3"]
+}
+PRESET_ORDER = list(SPEED_PRESETS)
 
 class DPGOpts():
-    def __init__(self, fps, dpg, width, height, keep_aspect):
+    def __init__(self, fps, dpg, width, height, keep_aspect, preset="quality"):
         self.fps = fps
         self.dpg = dpg
         self.width = width
         self.height = height
         self.keep_aspect = keep_aspect
+        self.preset = preset
         self.output = "."
 
     def verify_inputs(self):
@@ -56,6 +71,8 @@ class DPGOpts():
                 valid = False
             elif self.keep_aspect is not None and self.keep_aspect != "on":
                 valid = False
+            elif self.preset not in SPEED_PRESETS:
+                valid = False
 
         return valid
 
@@ -76,39 +93,137 @@ async def check_if_output_exists(file_name,stage):
     if file_size == 0:
         raise EncoderFailureException(message)
 
-### conversion steps
-async def convert_video(options,file,mpeg_1_temp):
-    # get video data using ffprobe
-    get_video_data = await asyncio.create_subprocess_exec("ffprobe", "-show_streams", file,
-                                                        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
-    # wait for process to complete and get output
-    video_data = await get_video_data.communicate()
-    frames = int(re.compile("avg_frame_rate=(.*)").search(video_data[0].decode("utf-8")).group(1).split("/")[0]) # find frame rate of the video
+def check_if_data_exists(data,stage):
+    # same as above, for stage outputs kept in memory
+    if not len(data):
+        raise EncoderFailureException(f"Encoding failed at {stage} stage. Please open an issue on GitHub or Codeberg.")
 
-    # prevent user error if set fps is bigger than video fps
-    if frames < options.fps:
-        options.fps = frames
+### media info
+# used to guess the length of files that don't store one, in bits per second
+ASSUMED_BITRATE = 1000000
+
+class MediaInfo():
+    def __init__(self, duration, fps, width, height, audio_channels, duration_estimated=False):
+        self.duration = duration # length in seconds
+        self.duration_estimated = duration_estimated # True if the length was guessed from the file size
+        self.fps = fps # average frame rate, as a Fraction
+        self.width = width
+        self.height = height
+        self.audio_channels = audio_channels # None if there is no audio stream
+
+async def run_ffprobe(args,timeout):
+    # run ffprobe with json output, returns None if it fails or takes longer than the timeout
+    proc = await asyncio.create_subprocess_exec("ffprobe", "-v", "error", "-print_format", "json", *args,
+                                                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    try:
+        output = await asyncio.wait_for(proc.communicate(), max(0,timeout))
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        # make sure ffprobe never outlives the probe, e.g. if the upload is cancelled
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+    if proc.returncode != 0:
+        return None
+    try:
+        return json.loads(output[0].decode("utf-8"))
+    except ValueError:
+        return None
+
+async def probe_media(file, timeout=10):
+    # get media info using ffprobe, giving up if it takes longer than the timeout
+    # raises an EncoderFailureException if the file can't be converted
+    message = "Your video could not be read or is not supported. Please try another file."
+    deadline = asyncio.get_running_loop().time() + timeout
+
+    data = await run_ffprobe(["-show_streams","-show_format",file],timeout)
+    if data is None:
+        raise EncoderFailureException(message)
 
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    if video is None:
+        raise EncoderFailureException("Your video does not contain a video stream. Please try another file.")
+    if not video.get("codec_name"):
+        raise EncoderFailureException(message)
+
+    # avg_frame_rate is a fraction such as 30000/1001, and is 0/0 if unknown
+    try:
+        fps = Fraction(video.get("avg_frame_rate", "0/0"))
+    except (ValueError,ZeroDivisionError):
+        fps = Fraction(0)
+    if fps <= 0:
+        raise EncoderFailureException("Your video has an unsupported frame rate. Please try another file.")
+
+    try:
+        width = int(video["width"])
+        height = int(video["height"])
+    except (KeyError,ValueError,TypeError):
+        raise EncoderFailureException(message)
+    if width <= 0 or height <= 0:
+        raise EncoderFailureException(message)
+
+    audio_channels = int(audio["channels"]) if audio is not None and audio.get("channels") else None
+
+    # some files (e.g. WebM from browser recordings) don't store their length
+    duration_estimated = False
+    try:
+        duration = float(data.get("format", {}).get("duration") or video.get("duration"))
+    except (ValueError,TypeError):
+        duration = 0
+    if duration <= 0:
+        if not audio_channels:
+            # a silent audio track can't be made without knowing the length
+            raise EncoderFailureException("Your video has no audio and its length could not be read. Please try another file.")
+        # the length is only used for queue estimates here, so a guess will do
+        file_size = (await aiofiles.os.stat(file)).st_size
+        duration = max(1, file_size * 8 / ASSUMED_BITRATE)
+        duration_estimated = True
+
+    # the headers can be fine while the video itself is not, so make sure the first frame decodes
+    frame_data = await run_ffprobe(["-select_streams","v:0","-read_intervals","%+#1","-count_frames",
+                                    "-show_entries","stream=nb_read_frames",file],
+                                   deadline - asyncio.get_running_loop().time())
+    try:
+        read_frames = int(frame_data["streams"][0]["nb_read_frames"])
+    except (TypeError,KeyError,IndexError,ValueError):
+        read_frames = 0
+    if read_frames < 1:
+        raise EncoderFailureException(message)
+
+    return MediaInfo(duration, fps, width, height, audio_channels, duration_estimated)
+
+### conversion steps
+def output_size(options,media_info):
+    # get the size the video will be scaled to before padding
     if options.keep_aspect == "on":
         # calculate aspect ratio
-        width = float(re.compile("width=(.*)").search(video_data[0].decode("utf-8")).group(1))
-        height = float(re.compile("height=(.*)").search(video_data[0].decode("utf-8")).group(1))
-        aspect_ratio = width/height
+        aspect_ratio = media_info.width/media_info.height
 
         if int(256.0/aspect_ratio) <= 192:
-            options.width=256
-            options.height=int(256.0/aspect_ratio)
+            return 256, int(256.0/aspect_ratio)
         else:
-            options.height=192
-            options.width=int(aspect_ratio*192.0)
+            return int(aspect_ratio*192.0), 192
+    return options.width, options.height
+
+async def convert_video(options,file,mpeg_1_temp,media_info):
+    frames = max(1, round(media_info.fps)) # find frame rate of the video
+
+    # prevent user error if set fps is bigger than video fps
+    if frames < options.fps:
+        options.fps = frames
+
+    options.width, options.height = output_size(options,media_info)
     pad_width = int((256-options.width)/2)
     pad_height = int((192-options.height)/2)
 
     proc = await asyncio.create_subprocess_exec("ffmpeg","-y","-i",file,"-f","data","-map","0:v:0","-r",str(options.fps),
                                                 "-sws_flags","lanczos","-vf",f"scale={options.width}:{options.height},pad=256:192:{pad_width}:{pad_height}",
-                                                "-codec:v","mpeg1video","-strict","experimental","-mbd","2",
-                                                "-trellis","1","-mpv_flags","+cbp_rd","-mpv_flags","+mv0","-g","11",
-                                                "-cmp","6","-subcmp","6","-precmp","6", "-dia_size","3","-pre_dia_size","3","-last_pred","3", mpeg_1_temp.name,
+                                                "-codec:v","mpeg1video","-strict","experimental","-g","11",
+                                                *SPEED_PRESETS[options.preset], mpeg_1_temp.name,
                                                 stdout=asyncio.subprocess.PIPE,stderr=asyncio.subprocess.DEVNULL)
 
     await proc.wait()
@@ -116,19 +231,11 @@ async def convert_video(options,file,mpeg_1_temp):
     # error checking
     await check_if_output_exists(mpeg_1_temp.name,"video")
 
-async def convert_audio(options,file,mpeg_2_temp):
-    # get audio data
-    get_audio_data = await asyncio.create_subprocess_exec("ffprobe", "-show_streams", file,
-                                                        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
-    # wait for process to complete and get output
-    audio_data = await get_audio_data.communicate()
-
+async def convert_audio(options,file,mpeg_2_temp,media_info):
     # check to see if there are any audio streams
-    channels = re.compile("channels=(.*)").search(audio_data[0].decode("utf-8"))
-
-    if channels:
+    if media_info.audio_channels:
         # store the number of channels
-        no_channels = int(channels.group(1))
+        no_channels = media_info.audio_channels
 
         if no_channels >= 2 and options.dpg != 0:
             # run mencoder with twolame to get stereo, 2 channel audio
@@ -147,73 +254,58 @@ async def convert_audio(options,file,mpeg_2_temp):
     else:
         # This condition will only be true if the video does not have an audio stream.
         # Having no audio stream will crash Moonshell as it's expecting something that doesn't exist
-        vid_length = re.compile("duration=([0-9]*.[0-9]*)").search(audio_data[0].decode("utf-8"))
-        if vid_length:
-            seconds = float(vid_length.group(1))
-            proc = await asyncio.create_subprocess_exec("ffmpeg","-y","-f","lavfi","-i","anullsrc","-t",str(seconds),"-map","0:a:0","-codec:a","libtwolame",
-                                                        "-b:a","128k","-mode","mono","-ac","1","-ar","32000",mpeg_2_temp.name,
-                                                        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
-            await proc.wait()
-        else:
-            pass # raise ERROR!
+        # probing rejects files with no audio and no length, so the duration is never a guess here
+        proc = await asyncio.create_subprocess_exec("ffmpeg","-y","-f","lavfi","-i","anullsrc","-t",str(media_info.duration),"-map","0:a:0","-codec:a","libtwolame",
+                                                    "-b:a","128k","-mode","mono","-ac","1","-ar","32000",mpeg_2_temp.name,
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        await proc.wait()
 
     # error checking
     await check_if_output_exists(mpeg_2_temp.name,"audio")
 
-async def calculate_gop(options,file,mpeg_1_temp,gop_temp):
+async def calculate_gop(options,mpeg_1_temp):
     """
     This is derived from dpgv4's gop calculation using ffprobe.
     All credits go to Pawel Slowik for this method!
     """
     frames = 0
+    gop = bytearray()
 
-    temp_gop_output = await aiofiles.tempfile.NamedTemporaryFile()
-    # get ffprobe data and store it to a file
-    async with aiofiles.open(temp_gop_output.name,"w") as writer:
-        proc = await asyncio.create_subprocess_exec("ffprobe","-hide_banner","-print_format","csv","-show_frames","-select_streams","v",mpeg_1_temp.name,stdout=writer,stderr=asyncio.subprocess.DEVNULL)
-        await proc.wait()
-
-    async with aiofiles.open(temp_gop_output.name,"r") as reader:
-        if options.dpg >= 2:
-            gop = await aiofiles.open(gop_temp.name,"wb")
-        while True:
-            line = await reader.readline()
-            if line == "":
-                break
-            data = line.split(",")
-            if data[0] != "frame":
-                continue
-            else:
-                if options.dpg >= 2 and data[22] == "I":
-                    await gop.write(struct.pack("<l",frames))
-                    await gop.write(struct.pack("<l",int(data[12])))
-                frames += 1
-
-        if options.dpg >= 2:
-            await gop.close()
+    # get ffprobe data straight from the pipe
+    proc = await asyncio.create_subprocess_exec("ffprobe","-hide_banner","-print_format","csv","-show_frames","-select_streams","v",mpeg_1_temp.name,
+                                                stdout=asyncio.subprocess.PIPE,stderr=asyncio.subprocess.DEVNULL)
+    output = await proc.communicate()
 
-    # error checking
-    await check_if_output_exists(gop_temp.name,"gop")
+    for line in output[0].decode("utf-8").splitlines():
+        data = line.split(",")
+        if data[0] != "frame":
+            continue
+        else:
+            if options.dpg >= 2 and data[22] == "I":
+                gop += struct.pack("<l",frames)
+                gop += struct.pack("<l",int(data[12]))
+            frames += 1
 
-    return frames
+    # error checking - only dpg 2+ has a gop
+    if options.dpg >= 2:
+        check_if_data_exists(gop,"gop")
 
-async def create_thumbnail(options,frames,thumb_temp,mpeg_1_temp):
-    # create temp dir to store image in
-    temp_dir = await aiofiles.tempfile.TemporaryDirectory()
-    orig_thumb_file = temp_dir.name + "/00000001.png"
+    return frames, bytes(gop)
 
-    # save a frame from the video as an image
-    proc = await asyncio.create_subprocess_exec("ffmpeg","-ss",f"{int((int(frames)/options.fps)/10)}","-i",mpeg_1_temp.name,"-frames","1",orig_thumb_file,
+async def create_thumbnail(options,frames,mpeg_1_temp):
+    # save a frame from the video as an image, sent through a pipe
+    proc = await asyncio.create_subprocess_exec("ffmpeg","-ss",f"{int((int(frames)/options.fps)/10)}","-i",mpeg_1_temp.name,"-frames","1",
+                                                "-f","image2pipe","-codec:v","png","-",
                                                 stdout=asyncio.subprocess.PIPE,stderr=asyncio.subprocess.DEVNULL)
 
     # wait for the process to complete
-    await proc.wait()
+    output = await proc.communicate()
 
     # error checking
-    await check_if_output_exists(orig_thumb_file,"thumbnail (ffmpeg)")
+    check_if_data_exists(output[0],"thumbnail (ffmpeg)")
 
     # original dpgconv thumbnail processing code
-    im = Image.open(orig_thumb_file)
+    im = Image.open(io.BytesIO(output[0]))
     width, height = im.size
     size = (256, 192)
     dest_w, dest_h = size
@@ -241,14 +333,12 @@ async def create_thumbnail(options,frames,thumb_temp,mpeg_1_temp):
     row_fmt=('H'*dest_w)
     thumb_data = b''.join(struct.pack(row_fmt, *row) for row in data)
 
-    # write data to file
-    async with aiofiles.open(thumb_temp.name,"wb") as writer:
-        await writer.write(thumb_data)
-
     # error checking
-    await check_if_output_exists(thumb_temp.name,"thumbnail (PIL)")
+    check_if_data_exists(thumb_data,"thumbnail (PIL)")
 
-async def write_header(options,tempfiles,frames):
+    return thumb_data
+
+async def write_header(options,frames,audio_temp,video_temp,gop):
     audiostart=36
     if options.dpg == 1:
         audiostart += 4
@@ -258,8 +348,8 @@ async def write_header(options,tempfiles,frames):
         audiostart += 98320
 
     # get audio/video stats
-    audiosize = await aiofiles.os.stat(tempfiles[2].name)
-    videosize = await aiofiles.os.stat(tempfiles[3].name)
+    audiosize = await aiofiles.os.stat(audio_temp.name)
+    videosize = await aiofiles.os.stat(video_temp.name)
 
     # replace the stats with size only
     audiosize = audiosize.st_size
@@ -273,81 +363,95 @@ async def write_header(options,tempfiles,frames):
 
     headerValues = [ DPG, int(frames), options.fps, 0, 32000 , 0 ,int(audiostart), int(audiosize), int(videostart), int(videosize) ]
 
-    # write header values
-    async with aiofiles.open(tempfiles[0].name,"wb") as f:
-        await f.write(struct.pack("4s", headerValues[0]))
-        await f.write(struct.pack("<l", headerValues[1]))
-        await f.write(struct.pack(">h", headerValues[2]))
-        await f.write(struct.pack(">h", headerValues[3]))
-        await f.write(struct.pack("<l", headerValues[4]))
-        await f.write(struct.pack("<l", headerValues[5]))
-        await f.write(struct.pack("<l", headerValues[6]))
-        await f.write(struct.pack("<l", headerValues[7]))
-        await f.write(struct.pack("<l", headerValues[8]))
-        await f.write(struct.pack("<l", headerValues[9]))
-
-        if options.dpg >= 2:
-            # write gop if dpg version is 2+
-            gopsize = await aiofiles.os.stat(tempfiles[4].name)
-            gopsize = gopsize.st_size
-            await f.write(struct.pack("<l", videoend))
-            await f.write(struct.pack("<l", gopsize))
-
-        if options.dpg != 0:
-            # this must be added in dpg versions besides 0
-            await f.write(struct.pack("<l", pixel_format))
+    # build header values
+    header = bytearray()
+    header += struct.pack("4s", headerValues[0])
+    header += struct.pack("<l", headerValues[1])
+    header += struct.pack(">h", headerValues[2])
+    header += struct.pack(">h", headerValues[3])
+    header += struct.pack("<l", headerValues[4])
+    header += struct.pack("<l", headerValues[5])
+    header += struct.pack("<l", headerValues[6])
+    header += struct.pack("<l", headerValues[7])
+    header += struct.pack("<l", headerValues[8])
+    header += struct.pack("<l", headerValues[9])
+
+    if options.dpg >= 2:
+        # write gop if dpg version is 2+
+        header += struct.pack("<l", videoend)
+        header += struct.pack("<l", len(gop))
+
+    if options.dpg != 0:
+        # this must be added in dpg versions besides 0
+        header += struct.pack("<l", pixel_format)
 
-        if options.dpg == 4:
-            # indicate thumbnail in dpg 4
-            await f.write(struct.pack("4s", b"THM0"))
+    if options.dpg == 4:
+        # indicate thumbnail in dpg 4
+        header += struct.pack("4s", b"THM0")
 
     # error checking
-    await check_if_output_exists(tempfiles[0].name,"header")
-
-async def create_full_file(options,tempfiles):
-    # open output dpg file
-    async with aiofiles.open(options.output,"wb") as writer:
-        # write each tempfile to the output file
-        for data in tempfiles:
-            async with aiofiles.open(data.name,"rb") as reader:
-                await writer.write(await reader.read())
+    check_if_data_exists(header,"header")
+
+    return bytes(header)
+
+async def splice_file(writer,file_name):
+    # copy a whole file into the output without reading it into python
+    async with aiofiles.open(file_name,"rb") as reader:
+        file_size = (await aiofiles.os.stat(file_name)).st_size
+        offset = 0
+        while offset < file_size:
+            sent = await aiofiles.os.sendfile(writer.fileno(),reader.fileno(),offset,file_size-offset)
+            if sent == 0:
+                break
+            offset += sent
+
+    # a short copy would leave the header pointing past the end of the file
+    if offset < file_size:
+        raise EncoderFailureException("Encoding failed at final stage. Please open an issue on GitHub or Codeberg.")
+
+async def write_all(writer,data):
+    # unbuffered writes can be partial, so keep going until everything is written
+    data = memoryview(data)
+    while len(data):
+        written = await writer.write(data)
+        data = data[written:]
+
+async def create_full_file(options,header,thumbnail,audio_temp,video_temp,gop):
+    # open output dpg file unbuffered, so writes and sendfile calls land in order
+    async with aiofiles.open(options.output,"wb",buffering=0) as writer:
+        # write each part to the output file in dpg order
+        await write_all(writer,header + thumbnail)
+        await splice_file(writer,audio_temp.name)
+        await splice_file(writer,video_temp.name)
+        await write_all(writer,gop)
 
     # error checking
     await check_if_output_exists(options.output,"final")
 
-async def encode(options,file):
-    """
-    temp files:
-        0 - header
-        1 - thumbnail
-        2 - audio
-        3 - video
-        4 - GOP
-    order was determined by DPG file structure
+async def encode(options,file,media_info=None,scratch_dir=None):
     """
-    temporary_files = [
-                       await aiofiles.tempfile.NamedTemporaryFile(suffix=".tmp"),
-                       await aiofiles.tempfile.NamedTemporaryFile(suffix=".tmp"),
-                       await aiofiles.tempfile.NamedTemporaryFile(suffix=".mp2"),
-                       await aiofiles.tempfile.NamedTemporaryFile(suffix=".mpg"),
-                       await aiofiles.tempfile.NamedTemporaryFile(suffix=".tmp")
-                      ]
-
-    # execute each step one by one
-    await convert_video(options,file,temporary_files[3])
-    await convert_audio(options,file,temporary_files[2])
-    frames = await calculate_gop(options,file,temporary_files[3],temporary_files[4])
-
-    # only dpg4 supported thumbnails
-    if options.dpg == 4:
-        await create_thumbnail(options,frames,temporary_files[1],temporary_files[3])
-    await write_header(options,temporary_files,frames)
+    The header, thumbnail and GOP are small, so they are kept in memory.
+    Audio and video are written by ffmpeg to temp files, which are put in
+    scratch_dir if set (e.g. a tmpfs mount), then spliced into the output.
+    Output order was determined by DPG file structure:
+        header, thumbnail, audio, video, GOP
 
-    if options.dpg < 2:
-        # remove thumbnail and gop if dpg ver is 0 or 1
-        temporary_files = [temporary_files[0],temporary_files[2],temporary_files[3]]
-    elif options.dpg < 4:
-        # remove thumbnail if dpg ver is 2 or 3
-        temporary_files = [temporary_files[0],temporary_files[2],temporary_files[3],temporary_files[4]]
+    media_info can be passed in if the file has already been probed
+    """
+    if media_info is None:
+        media_info = await probe_media(file)
+
+    async with aiofiles.tempfile.NamedTemporaryFile(suffix=".mp2",dir=scratch_dir) as audio_temp, \
+               aiofiles.tempfile.NamedTemporaryFile(suffix=".mpg",dir=scratch_dir) as video_temp:
+        # execute each step one by one
+        await convert_video(options,file,video_temp,media_info)
+        await convert_audio(options,file,audio_temp,media_info)
+        frames, gop = await calculate_gop(options,video_temp)
+
+        # only dpg4 supported thumbnails
+        thumbnail = b""
+        if options.dpg == 4:
+            thumbnail = await create_thumbnail(options,frames,video_temp)
+        header = await write_header(options,frames,audio_temp,video_temp,gop)
 
-    await create_full_file(options,temporary_files) # done!
+        await create_full_file(options,header,thumbnail,audio_temp,video_temp,gop) # done!
@@ -17,16 +17,22 @@ Copyright (C) 2025 Deletecat
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 """
-from sanic import Sanic, redirect, file
-from sanic.exceptions import SanicException
+from sanic import Sanic, redirect, file, empty
+from sanic.response import file_stream
+from sanic.exceptions import SanicException, HeaderNotFound, InvalidRangeType, RangeNotSatisfiable
+from sanic.handlers import ContentRangeHandler
 from sanic.log import logger
 from sanic_ext import render
 from werkzeug.utils import secure_filename
 from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
 import magic
+import os
 import re
 import asyncio
 import aiofiles
+import aiofiles.os
+import aiofiles.ospath
 import encoder
 
 app = Sanic("dpgonline")
@@ -35,8 +41,15 @@ class SilentError(SanicException):
     message = "Possible user error - silent"
     quiet = True
 
+class ServerBusyError(SilentError):
+    message = "The server is busy - silent"
+    status_code = 503
+
+    def __init__(self, message, retry_after):
+        super().__init__(message, headers={"Retry-After": str(int(retry_after))})
+
 class QueueObj():
-    def __init__(self, id, ifn, dpgopts, lp, ip):
+    def __init__(self, id, ifn, dpgopts, lp, ip, media_info):
         self.id = id
         self.input_filename = ifn
         self.dpg_opts = dpgopts
@@ -45,6 +58,47 @@ class QueueObj():
         self.last_ping = lp # set once added to queue, used to make sure user is still in the queue/converting
         self.request_ip = ip # limit object to user IP
         self.failure_message = "N/A" # set failure error
+        self.media_info = media_info # ffprobe result from upload, reused by the encoder
+        self.model_key = ThroughputModel.key(dpgopts,media_info) # set before the encoder changes the options
+        self.start_time = 0 # set once the encoding task starts
+        self.est_start = 0 # estimated start/finish timestamps
+        self.est_finish = 0
+
+class ThroughputModel():
+    """
+    Keeps track of how long past jobs took to encode, stored as encode seconds
+    per media second for each DPG version, resolution and speed preset.
+    """
+    def __init__(self, default_ratio):
+        self.default_ratio = default_ratio
+        self.ratios = {}
+
+    @staticmethod
+    def key(dpgopts, media_info):
+        # use the real output size, as width and height are ignored when keeping aspect ratio
+        width, height = encoder.output_size(dpgopts,media_info)
+        return (dpgopts.dpg, width, height, dpgopts.preset)
+
+    def record(self, key, encode_seconds, media_seconds):
+        if media_seconds <= 0:
+            return
+        ratio = encode_seconds / media_seconds
+        if key in self.ratios:
+            # weight recent jobs more heavily than older ones
+            self.ratios[key] = (self.ratios[key] * 0.7) + (ratio * 0.3)
+        else:
+            self.ratios[key] = ratio
+
+    def ratio(self, key):
+        if key in self.ratios:
+            return self.ratios[key]
+        elif len(self.ratios):
+            # no jobs with these settings yet, so use the average of the others
+            return sum(self.ratios.values()) / len(self.ratios)
+        return self.default_ratio
+
+    def estimate(self, queue_obj):
+        return queue_obj.media_info.duration * self.ratio(queue_obj.model_key)
 
 ### server init
 @app.before_server_start
@@ -84,6 +138,25 @@ async def init_server(app,loop):
     else:
         app.ctx.file_size = str(max_request_size/1000) + "KB"
 
+    # admission control limits, can be changed with SANIC_DPG_* environment variables
+    app.ctx.max_wait = int(app.config.get("DPG_MAX_WAIT", 3600)) # seconds
+    app.ctx.min_free_disk = int(app.config.get("DPG_MIN_FREE_DISK", 1000000000)) # bytes
+    app.ctx.throughput = ThroughputModel(float(app.config.get("DPG_DEFAULT_ENCODE_RATIO", 1.0)))
+    app.ctx.probe_timeout = float(app.config.get("DPG_PROBE_TIMEOUT", 10)) # seconds
+
+    # speed preset limits - the best preset users can pick, and when to switch to faster ones
+    app.ctx.best_preset = app.config.get("DPG_BEST_PRESET", "quality")
+    if app.ctx.best_preset not in encoder.SPEED_PRESETS:
+        raise ValueError(f"DPG_BEST_PRESET must be one of: {', '.join(encoder.PRESET_ORDER)}")
+    app.ctx.fast_queue_depth = int(app.config.get("DPG_FAST_QUEUE_DEPTH", 5))
+    app.ctx.fast_wait = int(app.config.get("DPG_FAST_WAIT", 1800)) # seconds
+
+    # optional scratch folder for encoder temp files, e.g. a tmpfs mount
+    app.ctx.scratch_dir = app.config.get("DPG_SCRATCH_DIR", None)
+    if app.ctx.scratch_dir is not None:
+        if not await aiofiles.ospath.isdir(app.ctx.scratch_dir) or not await aiofiles.os.access(app.ctx.scratch_dir, os.W_OK | os.X_OK):
+            raise ValueError(f"DPG_SCRATCH_DIR must be a writable folder: {app.ctx.scratch_dir}")
+
     # app version
     app.ctx.version = "v0.1.1"
 
@@ -159,8 +232,9 @@ async def last_ping_cleanup(app):
 ### background encoding tasks
 async def start_encoding(app):
     logger.info("Starting conversion task")
+    app.ctx.dpg_converting.start_time = int(datetime.timestamp(datetime.now()))
     try:
-        await encoder.encode(app.ctx.dpg_converting.dpg_opts, app.ctx.dpg_converting.input_filename)
+        await encoder.encode(app.ctx.dpg_converting.dpg_opts, app.ctx.dpg_converting.input_filename, app.ctx.dpg_converting.media_info, app.ctx.scratch_dir)
     except (encoder.EncoderFailureException,FileNotFoundError) as message:
         logger.info("Encoding task failed.")
         app.ctx.dpg_converting.failure_message = message
@@ -172,6 +246,12 @@ async def start_encoding(app):
         else:
             app.ctx.dpg_converting = None
     else:
+        # update the throughput model with how long this job took
+        # guessed lengths would only make the model less accurate, so they are skipped
+        if not app.ctx.dpg_converting.media_info.duration_estimated:
+            encode_time = int(datetime.timestamp(datetime.now())) - app.ctx.dpg_converting.start_time
+            app.ctx.throughput.record(app.ctx.dpg_converting.model_key,encode_time,app.ctx.dpg_converting.media_info.duration)
+
         # set download expiry and add to download list
         app.ctx.dpg_converting.expiry_time = int(datetime.timestamp(datetime.now())) + 1800 # downloads expire every half hour
         app.ctx.dpg_downloadable.append(app.ctx.dpg_converting)
@@ -210,6 +290,14 @@ async def upload_and_verify(request):
         # this should already be triggered by sanic, if not;
         raise SilentError("Your video is too big. Please compress your video before attempting to convert.", status_code=413)
 
+    # reject the upload early if the queue is too long or the disk is too full
+    wait_time = await update_estimates()
+    if wait_time > app.ctx.max_wait:
+        raise ServerBusyError("The queue is currently too long. Please try again later.", max(60,wait_time-app.ctx.max_wait))
+    disk_stats = await aiofiles.os.statvfs("./uploads")
+    if (disk_stats.f_bavail * disk_stats.f_frsize) - len(input_file.body) < app.ctx.min_free_disk:
+        raise ServerBusyError("The server is currently out of space. Please try again later.", 300) # downloads are cleaned up every 5 minutes
+
     # write our video to file
     async with aiofiles.open(input_filename,"wb") as writer:
         await writer.write(input_file.body)
@@ -220,19 +308,30 @@ async def upload_and_verify(request):
         await aiofiles.os.remove(input_filename)
         raise SilentError("Invalid file detected. Please try again.", status_code=400)
 
+    # make sure the video can be decoded before it takes a queue slot
+    try:
+        media_info = await encoder.probe_media(input_filename,app.ctx.probe_timeout)
+    except encoder.EncoderFailureException as e:
+        await aiofiles.os.remove(input_filename)
+        raise SilentError(e.message, status_code=400)
+
     # get dpg options
-    dpg_options = encoder.DPGOpts(request.form.get("fps"),request.form.get("dpg"),request.form.get("width"),request.form.get("height"),request.form.get("aspect"))
+    dpg_options = encoder.DPGOpts(request.form.get("fps"),request.form.get("dpg"),request.form.get("width"),request.form.get("height"),request.form.get("aspect"),
+                                  request.form.get("preset","quality"))
     is_valid = dpg_options.verify_inputs()
     if not is_valid:
         raise SilentError("Invalid input detected. Please try again.", status_code=400)
 
+    # limit the speed preset based on server settings and load
+    dpg_options.preset = choose_preset(dpg_options.preset,wait_time)
+
     # set output filename
     dpg_options.output = "./downloads/" + str(app.ctx.current_id) + ".dpg"
 
     dtn = datetime.timestamp(datetime.now())
 
     # add cookie to log user's video
-    queue_obj = QueueObj(app.ctx.current_id,input_filename,dpg_options,dtn,request.remote_addr)
+    queue_obj = QueueObj(app.ctx.current_id,input_filename,dpg_options,dtn,request.remote_addr,media_info)
 
     # if there is a task being converted, add the user's upload to the queue
     # otherwise, start the conversion task
@@ -278,11 +377,22 @@ async def user_queue(request):
 
     app.ctx.dpg_queue[queue_pos-1].last_ping = datetime.timestamp(datetime.now())
 
+    await update_estimates()
+    queue_obj = app.ctx.dpg_queue[queue_pos-1]
+
     if queue_pos == 1:
         queue_pos = "1 - Next video to be converted"
 
     # send message to user with 5 second refresh
-    return await render("queue.html",context={"queue_pos":str(queue_pos),"version":app.ctx.version,"queue_length":str(len(app.ctx.dpg_queue))},status=200)
+    return await render("queue.html",
+                        context={
+                                "queue_pos":str(queue_pos),
+                                "est_start":format_eta(queue_obj.est_start),
+                                "est_finish":format_eta(queue_obj.est_finish),
+                                "version":app.ctx.version,
+                                "queue_length":str(len(app.ctx.dpg_queue))
+                            },
+                        status=200)
 
 @app.get("/convert")
 async def convert_video(request):
@@ -322,7 +432,7 @@ async def convert_video(request):
     # send message to user with 5 second refresh
     return await render("convert.html",context={"version":app.ctx.version,"queue_length":str(len(app.ctx.dpg_queue))},status=200)
 
-@app.get("/download")
+@app.route("/download", methods=["GET","HEAD"])
 async def download_content(request):
     # get video id from cookie (will fail if none is set)
     try:
@@ -341,17 +451,88 @@ async def download_content(request):
             # no log of the video exists anywhere, so remove the video id cookie
             response = redirect("/")
             response.delete_cookie("video_id")
+            return response
 
     # if the video exists, but the visitors IP does not match the uploaders,
     # remove the video id cookie and redirect to the homepage
     elif app.ctx.dpg_downloadable[download-1].request_ip != request.remote_addr:
         response = redirect("/")
         response.delete_cookie("video_id")
+        return response
 
-    response = await file(app.ctx.dpg_downloadable[download-1].dpg_opts.output, filename=f"download{video_id}.dpg")
-    response.delete_cookie("video_id")
-    # send the file to the user
-    return response
+    # the video stays available until it expires, so the cookie is kept
+    # and interrupted downloads can be resumed with range requests
+    output = app.ctx.dpg_downloadable[download-1].dpg_opts.output
+    stats = await aiofiles.os.stat(output)
+    etag = f'"{stats.st_mtime_ns:x}-{stats.st_size:x}"'
+    last_modified = formatdate(stats.st_mtime, usegmt=True)
+    headers = {
+        "Accept-Ranges":"bytes",
+        "ETag":etag,
+        "Last-Modified":last_modified,
+        "Cache-Control":"private"
+    }
+
+    # let the client reuse its copy if it hasn't changed
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+            return empty(status=304, headers=headers)
+    elif request.headers.get("If-Modified-Since"):
+        try:
+            if parsedate_to_datetime(request.headers.get("If-Modified-Since")).timestamp() >= int(stats.st_mtime):
+                return empty(status=304, headers=headers)
+        except (TypeError,ValueError):
+            pass
+
+    # only send part of the file if the client's copy is the same as ours
+    # multiple ranges aren't supported, so those requests get the whole file
+    content_range = None
+    if_range = request.headers.get("If-Range")
+    if (if_range is None or if_range.strip() in (etag, last_modified)) and "," not in request.headers.get("Range",""):
+        try:
+            content_range = ContentRangeHandler(request, stats)
+        except (HeaderNotFound,InvalidRangeType):
+            # no range, or a range unit other than bytes, so send the whole file
+            pass
+        except RangeNotSatisfiable as e:
+            return empty(status=416, headers={**headers, **e.headers})
+
+    if content_range:
+        # sanic doesn't keep the range inside the file, so clamp it here
+        content_range.start = max(content_range.start, 0)
+        content_range.end = min(content_range.end, content_range.total - 1)
+        if content_range.start > content_range.end:
+            return empty(status=416, headers={**headers, "Content-Range":f"bytes */{content_range.total}"})
+        content_range.size = content_range.end - content_range.start + 1
+        content_range.headers = {"Content-Range":f"bytes {content_range.start}-{content_range.end}/{content_range.total}"}
+
+    headers["Content-Length"] = str(content_range.size if content_range else stats.st_size)
+    if content_range:
+        headers.update(content_range.headers)
+
+    if request.method == "HEAD":
+        headers["Content-Type"] = "application/octet-stream"
+        return empty(status=206 if content_range else 200, headers=headers)
+
+    if not content_range:
+        # send the file to the user in chunks rather than all at once
+        return await file_stream(output, chunk_size=65536, mime_type="application/octet-stream", headers=headers,
+                                 filename=f"download{video_id}.dpg")
+
+    # sanic's file_stream can send past the end of a range, so partial content is streamed here
+    headers["Content-Disposition"] = f'attachment; filename="download{video_id}.dpg"'
+    response = await request.respond(status=206, headers=headers, content_type="application/octet-stream")
+    async with aiofiles.open(output,"rb") as reader:
+        await reader.seek(content_range.start)
+        remaining = content_range.size
+        while remaining > 0:
+            chunk = await reader.read(min(remaining, 65536))
+            if not chunk:
+                break
+            await response.send(chunk)
+            remaining -= len(chunk)
+    await response.eof()
 
 @app.get("/failure")
 async def encoder_error_page(request):
@@ -385,6 +566,10 @@ async def send_favicon(request):
 # all errors go to the fancy page
 @app.exception(Exception)
 async def catch_all_errors(request, exception):
+    if isinstance(exception, ServerBusyError):
+        # keep the status code and retry-after header so clients know when to come back
+        return await render("error.html",context={"error_message":str(exception),"version":app.ctx.version,"queue_length":str(len(app.ctx.dpg_queue))},
+                            status=exception.status_code,headers=exception.headers)
     return await render("error.html",context={"error_message":str(exception),"version":app.ctx.version,"queue_length":str(len(app.ctx.dpg_queue))})
 
 ### extra functions
@@ -414,3 +599,48 @@ async def check_failures(id, r_index):
             else:
                 return True
     return False
+
+async def update_estimates():
+    # estimate when each job will start and finish using the throughput model
+    # returns the time in seconds until a newly uploaded video would start
+    cur_time = int(datetime.timestamp(datetime.now()))
+    next_start = cur_time
+
+    if app.ctx.dpg_converting is not None:
+        converting = app.ctx.dpg_converting
+        if converting.started and converting.start_time:
+            converting.est_start = converting.start_time
+        else:
+            converting.est_start = cur_time
+        # if the job is taking longer than expected, assume it is almost done
+        converting.est_finish = max(cur_time, converting.est_start + app.ctx.throughput.estimate(converting))
+        next_start = converting.est_finish
+
+    for queue_obj in app.ctx.dpg_queue:
+        queue_obj.est_start = next_start
+        queue_obj.est_finish = next_start + app.ctx.throughput.estimate(queue_obj)
+        next_start = queue_obj.est_finish
+
+    return int(next_start - cur_time)
+
+def choose_preset(preset,wait_time):
+    # never go above the best preset allowed by the server
+    index = min(encoder.PRESET_ORDER.index(preset), encoder.PRESET_ORDER.index(app.ctx.best_preset))
+
+    # drop down a preset for each threshold level the queue has passed
+    queue_depth = len(app.ctx.dpg_queue)
+    if queue_depth >= app.ctx.fast_queue_depth * 2 or wait_time >= app.ctx.fast_wait * 2:
+        index -= 2
+    elif queue_depth >= app.ctx.fast_queue_depth or wait_time >= app.ctx.fast_wait:
+        index -= 1
+
+    return encoder.PRESET_ORDER[max(0,index)]
+
+def format_eta(timestamp):
+    seconds = int(timestamp - datetime.timestamp(datetime.now()))
+    if seconds < 60:
+        return "less than a minute"
+    minutes = round(seconds / 60)
+    if minutes < 60:
+        return f"about {minutes} minute(s)"
+    return f"about {round(minutes / 60, 1)} hour(s)"